@@ -1,22 +1,28 @@
+import asyncio
 import datetime
 import logging
 import csv
-from dataclasses import dataclass
+import json
 import os
+from typing import NamedTuple
 from telegram import ReplyKeyboardMarkup, Update
+from telegram.error import TelegramError
 from telegram.ext import (
     filters, 
+    Application,
     ApplicationBuilder, 
     CommandHandler, 
     ConversationHandler, 
     ContextTypes, 
     MessageHandler, 
-    PicklePersistence
+    DictPersistence,
+    PersistenceInput,
+    AIORateLimiter
 )
 
-# Set up logging
+# Set up logging, the level can be set with the LOG_LEVEL environment variable (e.g. WARNING in production)
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                     level=logging.INFO)
+                     level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 # set higher logging level for httpx to avoid all GET and POST requests being logged
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
@@ -25,67 +31,244 @@ logger = logging.getLogger(__name__)
 # Conversation States
 SET_TIME, SET_LANGUAGE = range(2)
 
-@dataclass
-class BibleReadingScheduleEntry:
+# Seconds a reminder may be delayed before it is skipped for the day
+REMINDER_MISFIRE_GRACE_TIME = 5 * 60
+
+# Seconds by which reminders are spread randomly, so reminders set to the same time don't hit the API at once
+REMINDER_JITTER = 30
+
+# Reminder headlines by language, also sent alone if there is no reading for today
+REMINDER_HEADLINES = {
+    'de': 'Dies ist eine Erinnerung, die Bibel zu lesen.',
+    'en': 'This is a reminder to read the Bible.',
+}
+# Reminder messages with today's readings by language
+READING_REMINDER_TEMPLATES = {
+    'de': '<b>{headline}</b>\n\nAT: {ot}\nNT: {nt}',
+    'en': '<b>{headline}</b>\n\nOT: {ot}\nNT: {nt}',
+}
+
+# Poll question and options by language
+READING_POLLS = {
+    'de': ('Hast du heute schon die Bibel gelesen?', ['Ja', 'Nein']),
+    'en': ('Have you read the Bible today?', ['Yes', 'No']),
+}
+
+class BibleReadingScheduleEntry(NamedTuple):
     """Represents a Bible reading schedule entry."""
     date: datetime.date
     ot_reading: str
     nt_reading: str
 
 
-def get_todays_bible_reading(filename: str = 'schedule.csv') -> BibleReadingScheduleEntry:
-    """Reads the Bible reading schedule from a file and returns today's entry.
+class JsonFilePersistence(DictPersistence):
+    """Persists the user data (the language setting) in a JSON file.
+    
+    The file is only written if the user data has changed, at most once per persistence run, and the writing
+    is done in a separate thread, so the event loop isn't blocked.
+    """
+
+    def __init__(self, filepath: str, update_interval: float = 60):
+        """Initializes the persistence and loads the user data from the file if it exists.
+
+        Args:
+            filepath (str): The path of the JSON file.
+            update_interval (float, optional): The interval in seconds in which the data is persisted. Defaults to 60.
+        """
+        user_data_json = ''
+        if os.path.exists(filepath):
+            with open(filepath, 'r') as file:
+                user_data_json = file.read()
+        
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            user_data_json=user_data_json,
+            update_interval=update_interval
+        )
+        self.filepath = filepath
+        self._changed = False
+        self._write_lock = asyncio.Lock()
+        self._write_task: asyncio.Task | None = None
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        # PTB hands over the data of every user with an update, even if the data hasn't changed
+        if self.user_data is not None and self.user_data.get(user_id) == data:
+            return
+        await super().update_user_data(user_id, data)
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if self.user_data is None or user_id not in self.user_data:
+            return
+        await super().drop_user_data(user_id)
+        self._schedule_write()
+
+    async def flush(self) -> None:
+        if self._write_task is not None:
+            await self._write_task
+        await self._write()
+
+    def _schedule_write(self) -> None:
+        """Marks the user data as changed and schedules writing it to the file.
+        
+        The write task only runs after all user updates of the current persistence run, so the file is written
+        at most once per run.
+        """
+        self._changed = True
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_in_background())
+
+    async def _write_in_background(self) -> None:
+        """Writes the user data and logs a failure. The data stays marked as changed and is written again later."""
+        try:
+            await self._write()
+        except Exception:
+            logger.exception('Writing the user data to %s failed.', self.filepath)
+
+    async def _write(self) -> None:
+        """Writes the user data to the file as long as it has changed since the last write."""
+        async with self._write_lock:
+            # Changes made while the file is written are written in the next iteration
+            while self._changed:
+                self._changed = False
+                try:
+                    await asyncio.to_thread(self._write_file, json.dumps(self.user_data))
+                except Exception:
+                    self._changed = True
+                    raise
+
+    def _write_file(self, user_data_json: str) -> None:
+        # Write to a temporary file first, so the data file is never left half written
+        temp_filepath = self.filepath + '.tmp'
+        with open(temp_filepath, 'w') as file:
+            file.write(user_data_json)
+        os.replace(temp_filepath, self.filepath)
+
+
+# The date format used in the schedule file
+DATE_FORMAT = '%m-%d-%y'
+
+# The loaded schedules by file name together with the modification time of the file. The schedules are keyed
+# by date string and the values are the OT and NT readings.
+_schedules: dict[str, tuple[int, dict[str, tuple[str, str]]]] = {}
+
+
+def load_schedule(filename: str = 'schedule.csv') -> dict[str, tuple[str, str]]:
+    """Reads the whole Bible reading schedule from a file.
+    
+    The dates are kept as strings in the DATE_FORMAT, so no row has to be parsed as a date.
+
+    Args:
+        filename (str, optional): The name of the file containing the schedule. Defaults to 'schedule.csv'.
+
+    Returns:
+        dict[str, tuple[str, str]]: The OT and NT readings by date string.
+    """
+    schedule: dict[str, tuple[str, str]] = {}
+    mtime = os.stat(filename).st_mtime_ns
+    
+    # Read the schedule.csv file at once and let the (C implemented) csv module parse it.
+    # A plain split is not possible because the readings may contain quoted commas.
+    with open(filename, 'r', encoding='utf-8-sig') as file:
+        lines = file.read().splitlines()
+    
+    csv_reader = csv.reader(lines, delimiter=',', quotechar='"')
+    
+    # Skip the headline which we don't take into account
+    next(csv_reader, None)
+
+    for row in csv_reader:
+        # Skip malformed rows
+        if len(row) < 3:
+            continue
+        schedule[row[0]] = (row[2], row[1])
+    
+    _schedules[filename] = (mtime, schedule)
+    return schedule
+
+
+def get_todays_bible_reading(filename: str = 'schedule.csv') -> BibleReadingScheduleEntry | None:
+    """Returns today's entry of the Bible reading schedule.
+    
+    The schedule is kept in memory and only read again from the file if the file has been modified.
 
     Args:
         filename (str, optional): The name of the file containing the schedule. Defaults to 'schedule.csv'.
 
     Returns:
-        BibleReadingScheduleEntry: The Bible reading schedule entry for today.
+        BibleReadingScheduleEntry | None: The Bible reading schedule entry for today or None if there is none.
     """
-    # Get today's date
+    loaded = _schedules.get(filename)
+    if loaded is None or loaded[0] != os.stat(filename).st_mtime_ns:
+        schedule = load_schedule(filename)
+    else:
+        schedule = loaded[1]
+    
     today = datetime.date.today()
+    readings = schedule.get(today.strftime(DATE_FORMAT))
+    if readings is None:
+        return None
     
-    # Read the schedule.csv file
-    with open(filename, 'r') as file:
-        csv_reader = csv.reader(file, delimiter=',', quotechar='"')
-
-        # Find the entry for today's date
-        for row in csv_reader:
-            date_str   = row[0]
-            ot_reading = row[2]
-            nt_reading = row[1]
-            
-            # This is necessary for the headline which we don't take into account
-            try:
-                this_date = datetime.datetime.strptime(date_str, "%m-%d-%y").date()
-                if this_date == today:
-                    return BibleReadingScheduleEntry(this_date, ot_reading, nt_reading)
-            except:
-                next
-    
-    # If no entry is found for today, return None
-    return None
-
-async def specific_set_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Activates the Bible study reminder with a specific argument given"""
-    time_str = context.args[0].strip()
-    time_parts = time_str.split(':')
-    t = None
+    ot_reading, nt_reading = readings
+    return BibleReadingScheduleEntry(today, ot_reading, nt_reading)
+
+
+def _parse_hhmm(time_str: str) -> datetime.time | None:
+    """Parses a time in the format HH:MM (or H:MM).
+
+    Args:
+        time_str (str): The time string.
+
+    Returns:
+        datetime.time | None: The parsed time or None if the string is not a valid time.
+    """
+    time_str = time_str.strip()
+    if len(time_str) == 4:
+        time_str = '0' + time_str
+    
+    # fromisoformat also accepts other formats like "08", "0800" or "08:00+02:00", so check the shape first
+    if len(time_str) != 5 or time_str[2] != ':':
+        return None
     try:
-        hour = int(time_parts[0])
-        minute = int(time_parts[1])
-        t = datetime.time(hour, minute)
+        return datetime.time.fromisoformat(time_str)
     except ValueError:
+        return None
+
+
+async def _schedule_daily_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE, time_str: str) -> bool:
+    """Schedules a daily Bible study reminder for the chat at the given time.
+
+    Args:
+        update (Update): The update object from Telegram.
+        context (ContextTypes.DEFAULT_TYPE): The context object from Telegram.
+        time_str (str): The time of the reminder in the format HH:MM.
+
+    Returns:
+        bool: True if the reminder was scheduled, False if the time was invalid.
+    """
+    t = _parse_hhmm(time_str)
+    if t is None:
         await update.message.reply_text(text='Invalid time format. Please use the format HH:MM.')
-        return SET_TIME
+        return False
     
-    context.job_queue.run_daily(remind_bible_study, 
-                                t, 
-                                days=(0, 1, 2, 3, 4, 5, 6),
-                                chat_id=update.message.chat_id, 
-                                name=str(update.message.chat_id)
-                                )
+    # The user ID makes the user's language setting available in the reminder job
+    job = context.job_queue.run_daily(remind_bible_study, 
+                                      t, 
+                                      days=(0, 1, 2, 3, 4, 5, 6),
+                                      chat_id=update.message.chat_id, 
+                                      user_id=update.message.from_user.id,
+                                      name=str(update.message.chat_id),
+                                      job_kwargs={'jitter': REMINDER_JITTER}
+                                      )
+    # Keep the job, so it can be found without searching all jobs of the job queue
+    context.chat_data.setdefault('reminder_jobs', []).append(job)
     await update.message.reply_text(text=f'Activated Bible study reminder daily at {t.strftime("%H:%M")} UTC.')
+    return True
+
+
+async def specific_set_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Activates the Bible study reminder with a specific argument given"""
+    await _schedule_daily_reminder(update, context, context.args[0])
     
 
 async def create_bible_study_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -103,40 +286,22 @@ async def activate_bible_study_reminder(update: Update, context: ContextTypes.DE
         context (ContextTypes.DEFAULT_TYPE): The context object from Telegram.
     """
     
-    if update.message.text.strip() == '/cancel':
-        return await cancel_reminder_creation(context, update)
-    
-    logger.info('Activating Bible study reminder for %s.', update.message.from_user.first_name)
-    logger.info('The text was: %s', update.message.text)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Activating Bible study reminder for %s.', update.message.from_user.first_name)
+        logger.debug('The text was: %s', update.message.text)
     
-    # Parse the time from the message (e.g., "08:00")
-    time_str = update.message.text.strip()
-    time_parts = time_str.split(':')
-    t = None
-    try:
-        hour = int(time_parts[0])
-        minute = int(time_parts[1])
-        t = datetime.time(hour, minute)
-    except ValueError:
-        await update.message.reply_text(text='Invalid time format. Please use the format HH:MM.')
+    # Schedule the reminder at the time from the message (e.g., "08:00")
+    if not await _schedule_daily_reminder(update, context, update.message.text):
         return SET_TIME
-    
-    context.job_queue.run_daily(remind_bible_study, 
-                                t, 
-                                days=(0, 1, 2, 3, 4, 5, 6),
-                                chat_id=update.message.chat_id, 
-                                name=str(update.message.chat_id)
-                                )
-    await update.message.reply_text(text=f'Activated Bible study reminder daily at {t.strftime("%H:%M")} UTC.')    
     return ConversationHandler.END
 
 
-async def cancel_reminder_creation(context: ContextTypes.DEFAULT_TYPE, update: Update) -> int:
+async def cancel_reminder_creation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancels the creation of a reminder.
 
     Args:
-        context (ContextTypes.DEFAULT_TYPE): The context object from Telegram.
         update (Update): The update object from Telegram.
+        context (ContextTypes.DEFAULT_TYPE): The context object from Telegram.
 
     Returns:
         int: The end of the conversation.
@@ -178,36 +343,26 @@ async def send_reminder(context: ContextTypes.DEFAULT_TYPE, chat_id: int | str)
         context (ContextTypes.DEFAULT_TYPE): The context object from Telegram.
         chat_id (int | str): The chat ID to send the reminder to.
     """
-    todays_bible_reading: BibleReadingScheduleEntry = get_todays_bible_reading()
-    
-    if todays_bible_reading:
-        if context.user_data.get('language') == 'de':
-            await context.bot.send_message(chat_id, parse_mode='HTML', text=f'''
-            <b>Dies ist eine Erinnerung, die Bibel zu lesen.</b>
-            
-            AT: {todays_bible_reading.ot_reading}
-            NT: {todays_bible_reading.nt_reading}
-            ''')
-        else:
-            await context.bot.send_message(chat_id, parse_mode='HTML', text=f'''
-            <b>This is a reminder to read the Bible.</b>
-            
-            OT: {todays_bible_reading.ot_reading}
-            NT: {todays_bible_reading.nt_reading}
-            ''')
-    else:
-        if context.user_data.get('language') == 'de':   
-            await context.bot.send_message(chat_id, text='''
-                Dies ist eine Erinnerung, die Bibel zu lesen.
-            ''')
+    todays_bible_reading: BibleReadingScheduleEntry | None = get_todays_bible_reading()
+    lang = context.user_data.get('language', 'en')
+    
+    # Send the message before the poll, a failure of one of them shouldn't prevent the other
+    try:
+        if todays_bible_reading:
+            text = READING_REMINDER_TEMPLATES[lang].format(headline=REMINDER_HEADLINES[lang],
+                                                           ot=todays_bible_reading.ot_reading,
+                                                           nt=todays_bible_reading.nt_reading)
+            await context.bot.send_message(chat_id, parse_mode='HTML', text=text)
         else:
-            await context.bot.send_message(chat_id, text='''
-                This is a reminder to read the Bible.
-            ''')
-    if context.user_data.get('language') == 'de':
-        await context.bot.send_poll(chat_id, question='Hast du heute schon die Bibel gelesen?', options=['Ja', 'Nein'], is_anonymous=False)
-    else:
-        await context.bot.send_poll(chat_id, question='Have you read the Bible today?', options=['Yes', 'No'], is_anonymous=False)
+            await context.bot.send_message(chat_id, text=REMINDER_HEADLINES[lang])
+    except TelegramError as e:
+        logger.error('Sending the reminder message to %s failed: %s', chat_id, e)
+    
+    question, options = READING_POLLS[lang]
+    try:
+        await context.bot.send_poll(chat_id, question=question, options=options, is_anonymous=False)
+    except TelegramError as e:
+        logger.error('Sending the reminder poll to %s failed: %s', chat_id, e)
 
 
 async def respond_chat_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -228,8 +383,7 @@ async def delete_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         context (ContextTypes.DEFAULT_TYPE): The context object from Telegram.
         job (Job): The job to delete.
     """
-    # find job by name
-    jobs = context.job_queue.get_jobs_by_name(str(update.message.chat_id))
+    jobs = context.chat_data.pop('reminder_jobs', [])
     
     for j in jobs:
         j.schedule_removal()
@@ -245,7 +399,7 @@ async def send_all_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE)
         context (ContextTypes.DEFAULT_TYPE): The context object from Telegram.
     """
     
-    jobs = context.job_queue.get_jobs_by_name(str(update.message.chat_id))
+    jobs = context.chat_data.get('reminder_jobs', [])
     
     if not jobs:
         await update.message.reply_text(text='You have no active reminders. Create one with /createbiblestudyreminder.')
@@ -310,6 +464,15 @@ async def cancel_language_setting(update: Update, context: ContextTypes.DEFAULT_
     return ConversationHandler.END
 
 
+async def post_init(application: Application) -> None:
+    """Sets up the bot after the application has been initialized.
+
+    Args:
+        application (Application): The application of the bot.
+    """
+    await application.bot.set_my_description('This is a bot to remind you to read the Bible daily.')
+
+
 def main() -> None:
     
     # Get Bot token from env
@@ -317,19 +480,31 @@ def main() -> None:
     if not bot_token:
         raise ValueError('TELEGRAM_BOT_TOKEN not set in environment variables.')
     
+    # Read the schedule once, so reminders don't need to touch the file
+    load_schedule()
+    
     """The main function to run the bot."""
-    persistence = PicklePersistence(filepath='biblereadingbot_data');
+    persistence = JsonFilePersistence(filepath='biblereadingbot_data.json')
     
-    application = ApplicationBuilder().token(bot_token).persistence(persistence).build()
-
-    application.bot.set_my_description('This is a bot to remind you to read the Bible daily.')
+    # Keep the outgoing messages below Telegram's limit of 30 messages per second
+    rate_limiter = AIORateLimiter(overall_max_rate=30, max_retries=3)
+    
+    application = ApplicationBuilder().token(bot_token).persistence(persistence).rate_limiter(rate_limiter) \
+        .post_init(post_init).build()
 
     application.persistence_enabled = True
     
+    # The AsyncIOScheduler of the job queue sleeps until the next reminder is due. Allow reminders to be
+    # sent late if the event loop was busy at that time, but never more than once.
+    application.job_queue.scheduler.configure(
+        job_defaults={'misfire_grace_time': REMINDER_MISFIRE_GRACE_TIME, 'coalesce': True},
+        **application.job_queue.scheduler_configuration
+    )
+    
     set_timer_conversation_handler = ConversationHandler(
         entry_points=[CommandHandler('createbiblestudyreminder', create_bible_study_reminder)],
         states={
-            SET_TIME: [MessageHandler(None, activate_bible_study_reminder)],
+            SET_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, activate_bible_study_reminder)],
         },
         fallbacks=[CommandHandler('cancel', cancel_reminder_creation)]
     )
@@ -337,14 +512,14 @@ def main() -> None:
     set_language_conversation_handler = ConversationHandler(
         entry_points=[CommandHandler('setlang', set_language)],
         states={
-            SET_LANGUAGE: [MessageHandler(None, set_language)],
+            SET_LANGUAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_language)],
         },
         fallbacks=[CommandHandler('cancel', cancel_language_setting)]
     )
     
     application.add_handler(CommandHandler("start", start))   
     application.add_handler(CommandHandler("respondchatid", respond_chat_id))
-    application.add_handler(CommandHandler("remindbiblestudy", remind_bible_study_once))
+    application.add_handler(CommandHandler("remindbiblestudy", remind_bible_study_once, block=False))
     application.add_handler(CommandHandler("deletebiblestudyreminder", delete_reminder))
     application.add_handler(CommandHandler("sst", specific_set_time)) 
     application.add_handler(set_timer_conversation_handler)
@@ -1,11 +1,16 @@
+import asyncio
 import datetime
-from bot import get_todays_bible_reading, BibleReadingScheduleEntry
+import os
+import threading
+from bot import get_todays_bible_reading, BibleReadingScheduleEntry, JsonFilePersistence, _parse_hhmm
 
 TESTFILE = 'schedule_test.csv'
+PERSISTENCE_TESTFILE = 'persistence_test.json'
 
 def test_get_todays_bible_reading():
     # Create a sample schedule.csv file
     with open(TESTFILE, 'w') as file:
+        file.write("Date,New Testament (Morning Devotion), Old Testament (Evening Devotion)\n")
         file.write("01-01-22,Matthew 1,Genesis 1\n")
         file.write("01-02-22,Matthew 2,Genesis 2\n")
         file.write('01-03-22,Matthew 3,"Genesis 3"\n')
@@ -22,7 +27,139 @@ def test_get_todays_bible_reading():
         # Clean up the sample schedule.csv file
         #os.remove(TESTFILE)
         
+
+def test_get_todays_bible_reading_after_modification():
+    today = datetime.date.today().strftime('%m-%d-%y')
+    
+    with open(TESTFILE, 'w') as file:
+        file.write("Date,New Testament (Morning Devotion), Old Testament (Evening Devotion)\n")
+        file.write(f"{today},Matthew 4,Genesis 4\n")
+    get_todays_bible_reading(TESTFILE)
+    
+    # Change today's reading and make sure the modification time changes, independent of the timestamp resolution
+    mtime = os.stat(TESTFILE).st_mtime_ns
+    with open(TESTFILE, 'w') as file:
+        file.write("Date,New Testament (Morning Devotion), Old Testament (Evening Devotion)\n")
+        file.write(f"{today},Matthew 5,Genesis 5\n")
+    os.utime(TESTFILE, ns=(mtime + 1_000_000_000, mtime + 1_000_000_000))
+    
+    expected_entry = BibleReadingScheduleEntry(datetime.date.today(), 'Genesis 5', 'Matthew 5')
+    found_entry = get_todays_bible_reading(TESTFILE)
+    
+    assert found_entry == expected_entry, f"An error occurred: Expected entry is: {expected_entry}, but got {found_entry}"
+
+
+def test_json_file_persistence():
+    async def update_and_reload():
+        persistence = JsonFilePersistence(PERSISTENCE_TESTFILE)
+        await persistence.update_user_data(1, {'language': 'de'})
+        await persistence.update_user_data(2, {'language': 'en'})
+        await persistence.drop_user_data(2)
+        await persistence.flush()
+        
+        return await JsonFilePersistence(PERSISTENCE_TESTFILE).get_user_data()
+    
+    if os.path.exists(PERSISTENCE_TESTFILE):
+        os.remove(PERSISTENCE_TESTFILE)
+    
+    try:
+        user_data = asyncio.run(update_and_reload())
+        assert user_data == {1: {'language': 'de'}}, \
+            f"An error occurred: Expected user data is: {{1: {{'language': 'de'}}}}, but got {user_data}"
+    finally:
+        os.remove(PERSISTENCE_TESTFILE)
+
+
+def test_json_file_persistence_failed_write():
+    async def fail_once_and_flush():
+        persistence = JsonFilePersistence(PERSISTENCE_TESTFILE)
+        write_file = persistence._write_file
+        
+        def failing_write_file(user_data_json):
+            # Fail only the first write
+            persistence._write_file = write_file
+            raise OSError('Disk full')
+        
+        persistence._write_file = failing_write_file
+        await persistence.update_user_data(1, {'language': 'de'})
+        await persistence._write_task
+        await persistence.flush()
+        
+        return await JsonFilePersistence(PERSISTENCE_TESTFILE).get_user_data()
+    
+    if os.path.exists(PERSISTENCE_TESTFILE):
+        os.remove(PERSISTENCE_TESTFILE)
+    
+    try:
+        user_data = asyncio.run(fail_once_and_flush())
+        assert user_data == {1: {'language': 'de'}}, \
+            f"An error occurred: Expected user data is: {{1: {{'language': 'de'}}}}, but got {user_data}"
+    finally:
+        os.remove(PERSISTENCE_TESTFILE)
+
+
+def test_json_file_persistence_update_during_write():
+    async def update_during_write():
+        persistence = JsonFilePersistence(PERSISTENCE_TESTFILE)
+        write_file = persistence._write_file
+        write_started = threading.Event()
+        continue_write = threading.Event()
+        
+        def blocking_write_file(user_data_json):
+            # Block only the first write until the second update has been made
+            persistence._write_file = write_file
+            write_started.set()
+            continue_write.wait()
+            write_file(user_data_json)
+        
+        persistence._write_file = blocking_write_file
+        await persistence.update_user_data(1, {'language': 'de'})
+        while not write_started.is_set():
+            await asyncio.sleep(0.01)
+        
+        await persistence.update_user_data(2, {'language': 'en'})
+        continue_write.set()
+        await persistence._write_task
+        
+        # No flush, the running write has to pick up the second update by itself
+        return await JsonFilePersistence(PERSISTENCE_TESTFILE).get_user_data()
+    
+    if os.path.exists(PERSISTENCE_TESTFILE):
+        os.remove(PERSISTENCE_TESTFILE)
+    
+    try:
+        user_data = asyncio.run(update_during_write())
+        expected_user_data = {1: {'language': 'de'}, 2: {'language': 'en'}}
+        assert user_data == expected_user_data, \
+            f"An error occurred: Expected user data is: {expected_user_data}, but got {user_data}"
+    finally:
+        os.remove(PERSISTENCE_TESTFILE)
+
+
+def test_parse_hhmm():
+    cases = {
+        '08:00': datetime.time(8, 0),
+        ' 23:59 ': datetime.time(23, 59),
+        '8:00': datetime.time(8, 0),
+        '08': None,
+        '0800': None,
+        '08:00:30': None,
+        '08:00+02:00': None,
+        '24:00': None,
+        'abc': None,
+    }
+    for time_str, expected_time in cases.items():
+        parsed_time = _parse_hhmm(time_str)
+        assert parsed_time == expected_time, \
+            f"An error occurred: Expected {expected_time} for {time_str!r}, but got {parsed_time}"
+
+
 if __name__ == '__main__':
     print('Start Testing')
     test_get_todays_bible_reading()
+    test_get_todays_bible_reading_after_modification()
+    test_json_file_persistence()
+    test_json_file_persistence_failed_write()
+    test_json_file_persistence_update_during_write()
+    test_parse_hhmm()
     print('All tests passed')